@@ -9,6 +9,9 @@ import traceback
 import sqlite3
 from passlib.hash import pbkdf2_sha256
 import re
+import queue
+import threading
+import warnings
 
 
 def get_db_path():
@@ -17,9 +20,21 @@ def get_db_path():
     return 'prepclass.db'  # Local development path
 
 
-# Database setup
+# Open a tuned connection (WAL journal, relaxed fsync, wait on locks)
+def connect_db():
+    conn = sqlite3.connect(get_db_path(), isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+# Database setup. Cached as a resource, so the schema is created at most once per process and the
+# same long-lived connection is handed back on every rerun.
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect(get_db_path())
+    conn = connect_db()
     c = conn.cursor()
     
     # Users table
@@ -36,76 +51,157 @@ def init_db():
                   timestamp TEXT,
                   pre_class TEXT,
                   in_class TEXT,
-                  post_class TEXT)''')
+                  post_class TEXT,
+                  truncated INTEGER NOT NULL DEFAULT 0)''')
+    
+    # Databases created before the truncated flag existed get the column added
+    c.execute("PRAGMA table_info(history)")
+    if "truncated" not in [column[1] for column in c.fetchall()]:
+        c.execute("ALTER TABLE history ADD COLUMN truncated INTEGER NOT NULL DEFAULT 0")
+    
+    # Databases created before the unique index existed may hold duplicate (username, topic) rows;
+    # keep only the newest so the index can be built. Once the index exists this is skipped.
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", ("idx_history_user_topic",))
+    if not c.fetchone():
+        c.execute('''DELETE FROM history WHERE id NOT IN
+                     (SELECT MAX(id) FROM history GROUP BY username, topic)''')
+    
+    # One row per user and topic; also the conflict target for the save upsert
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_history_user_topic
+                 ON history(username, topic)''')
+    
+    # Lets the newest-first history listing read the index in order instead of sorting
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_history_user_ts
+                 ON history(username, timestamp DESC)''')
+    
+    # Saved-materials lookup is per user now and served by idx_history_user_topic
+    c.execute("DROP INDEX IF EXISTS idx_history_topic_difficulty")
     
     conn.commit()
-    conn.close()
+    return conn
+
+get_conn = init_db
+
+# Password hashing; rounds can be tuned via PBKDF2_ROUNDS (e.g. lowered for local development).
+# Verification reads the rounds stored in each hash, so existing accounts keep working.
+DEFAULT_PBKDF2_ROUNDS = 29000
+MIN_PBKDF2_ROUNDS = 10000
 
-init_db()
+def get_pbkdf2_rounds():
+    value = os.environ.get("PBKDF2_ROUNDS")
+    if value is None:
+        return DEFAULT_PBKDF2_ROUNDS
+    try:
+        rounds = int(value)
+    except ValueError:
+        rounds = None
+    if rounds is None or rounds < MIN_PBKDF2_ROUNDS:
+        # Never crash login or silently weaken new hashes because of a bad setting
+        warnings.warn(f"Ignoring PBKDF2_ROUNDS={value!r}: must be an integer >= {MIN_PBKDF2_ROUNDS}; "
+                      f"using {DEFAULT_PBKDF2_ROUNDS}")
+        return DEFAULT_PBKDF2_ROUNDS
+    return rounds
+
+password_hasher = pbkdf2_sha256.using(rounds=get_pbkdf2_rounds())
 
-# Password hashing
 def hash_password(password):
-    return pbkdf2_sha256.hash(password)
+    return password_hasher.hash(password)
 
 def verify_password(password, hashed):
     return pbkdf2_sha256.verify(password, hashed)
 
+# Valid usernames: 3-20 letters, digits or underscores
+USERNAME_RE = re.compile(r"\A[A-Za-z0-9_]{3,20}\Z")
+
 # Authentication functions
 def create_user(username, password):
-    conn = sqlite3.connect('prepclass.db')
-    c = conn.cursor()
+    conn = get_conn()
     try:
-        c.execute("INSERT INTO users VALUES (?, ?)", 
-                 (username, hash_password(password)))
-        conn.commit()
+        with conn:
+            conn.execute("INSERT INTO users VALUES (?, ?)", 
+                         (username, hash_password(password)))
         return True
     except sqlite3.IntegrityError:
         return False  # Username exists
-    finally:
-        conn.close()
 
 def authenticate_user(username, password):
-    conn = sqlite3.connect('prepclass.db')
+    conn = get_conn()
     c = conn.cursor()
     c.execute("SELECT password_hash FROM users WHERE username=?", (username,))
     result = c.fetchone()
-    conn.close()
     if result and verify_password(password, result[0]):
         return True
     return False
 
 # History database functions
-def save_history_to_db(username, topic, difficulty, content):
-    conn = sqlite3.connect(get_db_path())
+# `truncated` marks a generation where a document hit the token cap; it stays in the user's
+# history but is never reused as saved materials
+def save_history_to_db(username, topic, difficulty, content, truncated=False):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
+    conn = get_conn()
+    with conn:
+        # Single upsert: one statement, one commit, no gap between checking and writing
+        conn.execute('''INSERT INTO history 
+                        (username, topic, difficulty, timestamp, pre_class, in_class, post_class, truncated)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(username, topic) DO UPDATE SET 
+                        difficulty=excluded.difficulty, timestamp=excluded.timestamp, 
+                        pre_class=excluded.pre_class, in_class=excluded.in_class, 
+                        post_class=excluded.post_class, truncated=excluded.truncated''',
+                     (username, topic, difficulty, timestamp,
+                      content["pre_class"], content["in_class"], content["post_class"],
+                      int(truncated)))
+    return timestamp
+
+# This user's previously generated materials for the same topic and difficulty; None if no
+# complete set (all three documents non-empty and none cut off) was generated
+def find_cached_materials(username, topic, difficulty):
+    conn = get_conn()
     c = conn.cursor()
-    
-    # Check if topic exists for this specific user
-    c.execute('''SELECT id FROM history 
-                 WHERE username=? AND topic=?''', (username, topic))
-    exists = c.fetchone()
-    
-    if exists:
-        c.execute('''UPDATE history SET 
-                    difficulty=?, timestamp=?, 
-                    pre_class=?, in_class=?, post_class=?
-                    WHERE username=? AND id=?''',
-                 (difficulty, datetime.now().strftime("%Y-%m-%d %H:%M"),
-                  content["pre_class"], content["in_class"], content["post_class"],
-                  username, exists[0]))
-    else:
-        c.execute('''INSERT INTO history 
-                    (username, topic, difficulty, timestamp, pre_class, in_class, post_class)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                 (username, topic, difficulty, 
-                  datetime.now().strftime("%Y-%m-%d %H:%M"),
-                  content["pre_class"], content["in_class"], content["post_class"]))
-    
-    conn.commit()
-    conn.close()
+    c.execute('''SELECT pre_class, in_class, post_class 
+                FROM history WHERE username=? AND topic=? AND difficulty=? 
+                AND pre_class <> '' AND in_class <> '' AND post_class <> '' 
+                AND truncated = 0''',
+              (username, topic, difficulty))
+    result = c.fetchone()
+    if not result:
+        return None
+    pre_class, in_class, post_class = result
+    return {
+        "pre_class": pre_class,
+        "in_class": in_class,
+        "post_class": post_class
+    }
+
+# Sidebar listing only: (topic, difficulty, timestamp) per entry, newest first, without the document bodies
+def list_history_titles(username):
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('''SELECT topic, difficulty, timestamp 
+                FROM history WHERE username=? 
+                ORDER BY timestamp DESC''', (username,))
+    return c.fetchall()
 
-# Load history for every user separately
+# Full documents for one topic, fetched when the user loads it
+def load_history_entry(username, topic):
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('''SELECT difficulty, pre_class, in_class, post_class 
+                FROM history WHERE username=? AND topic=?''', (username, topic))
+    result = c.fetchone()
+    if not result:
+        return None
+    difficulty, pre_class, in_class, post_class = result
+    return {
+        "difficulty": difficulty,
+        "pre_class": pre_class,
+        "in_class": in_class,
+        "post_class": post_class
+    }
+
+# Load history for every user separately (full bodies; used for the JSON export)
 def load_history_from_db(username):
-    conn = sqlite3.connect(get_db_path())
+    conn = get_conn()
     c = conn.cursor()
     c.execute('''SELECT topic, difficulty, timestamp, 
                 pre_class, in_class, post_class 
@@ -121,9 +217,71 @@ def load_history_from_db(username):
             "in_class": in_class,
             "post_class": post_class
         }
-    conn.close()
     return history
 
+# System prompts, one per document. Each is the persona plus that document's rubric and is identical
+# on every request for its section; the topic and difficulty go at the end of the user message.
+MENTOR_PERSONA = """You are an expert computer science mentor preparing IIT Bombay students for placements.
+Keep each document concise: roughly 800 words at most.
+"""
+
+SECTION_PROMPTS = {
+    "pre_class": MENTOR_PERSONA + """
+Create a comprehensive pre-class document for undergraduate students at the given difficulty level preparing for placement interviews.
+
+Document should include:
+1. Brief overview (1 paragraph)
+2. 5 key concepts with concise explanations
+3. Prerequisite knowledge required
+4. Real-world applications (2-3 examples)
+5. Recommended pre-reading (3-5 bullet points)
+6. Common interview questions related to the topic
+
+Format as a structured document with clear headings. Use academic but accessible language.
+""",
+    "in_class": MENTOR_PERSONA + """
+Create a detailed 1-hour lesson plan for teaching the given topic to students at IIT Bombay at the given difficulty level.
+
+Structure:
+1. Learning objectives (3-5 bullet points)
+2. Time-allocated session breakdown:
+   - Introduction (5 minutes)
+   - Core concept explanation (15 minutes)
+   - Practical example walkthrough (20 minutes)
+   - Student practice activity (15 minutes)
+   - Q&A and summary (5 minutes)
+3. Teaching tips and common pitfalls
+4. Required materials/resources
+5. Engagement strategies for each section
+6. Whiteboard diagrams/examples to use
+
+Include specific IIT Bombay context where relevant.
+""",
+    "post_class": MENTOR_PERSONA + """
+Create a post-class document for the given topic at the given difficulty level including:
+
+1. Key takeaways summary (1 paragraph)
+2. 8-question quiz (4 MCQ, 2 true/false, 2 short answer) with solutions
+3. Additional practice problems (3-5) with difficulty ratings
+4. Recommended next steps/resources for further learning
+5. Common mistakes to avoid in interviews
+
+Format with clear section headings. Include IIT-specific examples where appropriate.
+""",
+}
+
+# Output cap per document; billing and latency both scale with generated tokens
+MAX_DOCUMENT_TOKENS = 1500
+
+# Queued after a document's last token when it was cut off by MAX_DOCUMENT_TOKENS
+TRUNCATED = object()
+
+# One OpenAI client per API key, so its HTTP connection pool stays warm across requests and reruns.
+# Bounded so clients (and the keys they hold) for past users don't stay in memory indefinitely.
+@st.cache_resource(max_entries=16, ttl=3600)
+def get_openai(api_key):
+    return OpenAI(api_key=api_key)
+
 # Authentication UI
 def auth_ui():
     st.title("Cantiliver AI Mentor Login")
@@ -151,7 +309,7 @@ def auth_ui():
                     st.error("Username and password required")
                 elif new_pass != confirm_pass:
                     st.error("Passwords don't match")
-                elif not re.match("^[a-zA-Z0-9_]{3,20}$", new_user):
+                elif not USERNAME_RE.match(new_user):
                     st.error("Username must be 3-20 chars (letters, numbers, _)")
                 elif len(new_pass) < 8:
                     st.error("Password must be at least 8 characters")
@@ -164,8 +322,9 @@ def auth_ui():
 # Main App
 def main_app():
     # Initialize session state for history
-    if 'history' not in st.session_state or st.session_state.get('current_user') != st.session_state.username:
-        st.session_state.history = load_history_from_db(st.session_state.username)
+    if 'history_titles' not in st.session_state or st.session_state.get('current_user') != st.session_state.username:
+        st.session_state.history_titles = list_history_titles(st.session_state.username)
+        st.session_state.history_export = None
         st.session_state.current_user = st.session_state.username
     
     if 'current_topic' not in st.session_state:
@@ -181,6 +340,36 @@ def main_app():
     if 'selected_difficulty' not in st.session_state:
         st.session_state.selected_difficulty = "Beginner"
 
+    # The difficulty selectbox is driven by its session state key, so it always shows the value
+    # generation and the saved-materials lookup use
+    if 'difficulty_display' not in st.session_state:
+        st.session_state.difficulty_display = st.session_state.selected_difficulty
+
+    # Button callbacks run before the next script run, i.e. before the sidebar widgets are drawn
+    def load_selected_topic():
+        selected_topic = st.session_state.history_select
+        history = load_history_entry(st.session_state.username, selected_topic)
+        st.session_state.current_topic = selected_topic
+        st.session_state.displayed_content = {
+            "pre_class": history["pre_class"],
+            "in_class": history["in_class"],
+            "post_class": history["post_class"]
+        }
+        st.session_state.selected_difficulty = history["difficulty"]
+        st.session_state.difficulty_display = history["difficulty"]
+
+    def clear_history():
+        st.session_state.history_titles = []
+        st.session_state.history_export = None
+        st.session_state.current_topic = None
+        st.session_state.displayed_content = {
+            "pre_class": None,
+            "in_class": None,
+            "post_class": None
+        }
+        st.session_state.selected_difficulty = "Beginner"
+        st.session_state.difficulty_display = "Beginner"
+
     # Configure the app
     st.set_page_config(page_title="Placement Mentor", page_icon="🎓", layout="wide")
     st.title("🎓 Placement Mentor Dashboard")
@@ -202,45 +391,22 @@ def main_app():
         # Difficulty select
         difficulty = st.selectbox("Select Difficulty Level:", 
                                  ["Beginner", "Intermediate", "Advanced"],
-                                 key="difficulty_display",
-                                 index=["Beginner", "Intermediate", "Advanced"].index(st.session_state.selected_difficulty))
+                                 key="difficulty_display")
+        st.session_state.selected_difficulty = difficulty
+        
+        regenerate = st.checkbox("Regenerate (ignore saved materials)", key="regenerate_check",
+                                 help="Call GPT-4o again even if this topic and difficulty were generated before")
         
         generate_btn = st.button("Generate Learning Materials", type="primary", key="generate_btn")
         
         st.divider()
         st.header("History")
         
-        # Display history with selection
-        if st.session_state.history:
-            history_topics = list(st.session_state.history.keys())
-            selected_topic = st.selectbox("Previously Generated Topics:", history_topics, key="history_select")
-            
-            if st.button("Load Selected Topic", key="load_topic_btn"):
-                # Load content from history without modifying widget states
-                st.session_state.current_topic = selected_topic
-                history = st.session_state.history[selected_topic]
-                st.session_state.displayed_content = {
-                    "pre_class": history["pre_class"],
-                    "in_class": history["in_class"],
-                    "post_class": history["post_class"]
-                }
-                # Update the selected difficulty in our safe session state variable
-                st.session_state.selected_difficulty = history["difficulty"]
-                st.rerun()
-        else:
-            st.info("No generation history yet")
+        # Filled in after generation below, so a topic generated in this run already shows up
+        history_section = st.container()
         
         # Clear history button
-        if st.button("Clear History", key="clear_history_btn"):
-            st.session_state.history = {}
-            st.session_state.current_topic = None
-            st.session_state.displayed_content = {
-                "pre_class": None,
-                "in_class": None,
-                "post_class": None
-            }
-            st.session_state.selected_difficulty = "Beginner"
-            st.rerun()
+        st.button("Clear History", key="clear_history_btn", on_click=clear_history)
         
         # Logout button
         if st.button("Logout"):
@@ -249,117 +415,150 @@ def main_app():
             st.rerun()
 
     # Document generation functions using GPT-4o
-    def generate_document(prompt, api_key):
-        client = OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are an expert computer science mentor preparing IIT Bombay students for placements."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
+    # Tokens are pushed onto `sink` as they arrive; None marks the end, an exception is forwarded as-is,
+    # and TRUNCATED is pushed before the end if the output hit the token cap
+    def generate_document(section, prompt, client, sink):
+        try:
+            stream = client.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": SECTION_PROMPTS[section]},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.3,
+                max_tokens=MAX_DOCUMENT_TOKENS,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices:
+                    choice = chunk.choices[0]
+                    sink.put(choice.delta.content or "")
+                    if choice.finish_reason == "length":
+                        sink.put(TRUNCATED)
+        except Exception as e:
+            sink.put(e)
+        finally:
+            sink.put(None)
 
-    def generate_pre_class(topic, difficulty, api_key):
-        prompt = f"""
-        Create a comprehensive pre-class document for {difficulty.lower()} level undergraduate students preparing for placement interviews. 
-        Topic: {topic}
-        
-        Document should include:
-        1. Brief overview (1 paragraph)
-        2. 5 key concepts with concise explanations
-        3. Prerequisite knowledge required
-        4. Real-world applications (2-3 examples)
-        5. Recommended pre-reading (3-5 bullet points)
-        6. Common interview questions related to the topic
-        
-        Format as a structured document with clear headings. Use academic but accessible language.
-        """
-        return generate_document(prompt, api_key)
+    # Only the topic and difficulty vary per request, and they come last
+    def generate_pre_class(topic, difficulty, client, sink):
+        generate_document("pre_class", f"Topic: {topic}\nDifficulty: {difficulty.lower()} level", client, sink)
 
-    def generate_in_class(topic, difficulty, api_key):
-        prompt = f"""
-        Create a detailed 1-hour lesson plan for teaching {topic} to {difficulty.lower()} level students at IIT Bombay.
-        
-        Structure:
-        1. Learning objectives (3-5 bullet points)
-        2. Time-allocated session breakdown:
-           - Introduction (5 minutes)
-           - Core concept explanation (15 minutes)
-           - Practical example walkthrough (20 minutes)
-           - Student practice activity (15 minutes)
-           - Q&A and summary (5 minutes)
-        3. Teaching tips and common pitfalls
-        4. Required materials/resources
-        5. Engagement strategies for each section
-        6. Whiteboard diagrams/examples to use
-        
-        Include specific IIT Bombay context where relevant.
-        """
-        return generate_document(prompt, api_key)
+    def generate_in_class(topic, difficulty, client, sink):
+        generate_document("in_class", f"Topic: {topic}\nDifficulty: {difficulty.lower()} level", client, sink)
 
-    def generate_post_class(topic, difficulty, api_key):
-        prompt = f"""
-        Create a post-class document for {topic} at {difficulty.lower()} level including:
-        
-        1. Key takeaways summary (1 paragraph)
-        2. 8-question quiz (4 MCQ, 2 true/false, 2 short answer) with solutions
-        3. Additional practice problems (3-5) with difficulty ratings
-        4. Recommended next steps/resources for further learning
-        5. Common mistakes to avoid in interviews
-        
-        Format with clear section headings. Include IIT-specific examples where appropriate.
-        """
-        return generate_document(prompt, api_key)
+    def generate_post_class(topic, difficulty, client, sink):
+        generate_document("post_class", f"Topic: {topic}\nDifficulty: {difficulty.lower()} level", client, sink)
 
-    # PDF generation with built-in font to avoid external dependencies
+    # Fire all three requests at once over the shared client so wall time is the slowest call, not the sum.
+    # Each runs on its own thread so the UI can render tokens while they arrive.
+    def start_generation(topic, difficulty, api_key):
+        client = get_openai(api_key)
+        streams = {}
+        for section, generate in (("pre_class", generate_pre_class),
+                                  ("in_class", generate_in_class),
+                                  ("post_class", generate_post_class)):
+            streams[section] = queue.Queue()
+            threading.Thread(
+                target=generate,
+                args=(topic, difficulty, client, streams[section]),
+                daemon=True
+            ).start()
+        return streams
+
+    # Yields the text of one document; `truncated` is appended to if it was cut off
+    def read_stream(sink, truncated):
+        while True:
+            piece = sink.get()
+            if piece is None:
+                return
+            if piece is TRUNCATED:
+                truncated.append(piece)
+                continue
+            if isinstance(piece, Exception):
+                raise piece
+            yield piece
+
+    # PDF generation with built-in font to avoid external dependencies.
+    # Cached on the arguments, so unrelated reruns reuse the bytes built for the same document.
+    @st.cache_data(max_entries=32, show_spinner=False)
     def create_pdf(content, filename):
         pdf = FPDF()
         pdf.add_page()
         pdf.set_font("Arial", size=12)
         
-        # Function to clean text for PDF
-        def clean_text(text):
-            return text.encode('latin-1', 'replace').decode('latin-1')
+        # Built-in fonts are latin-1 only; replace anything else once for the whole document
+        content = content.encode('latin-1', 'replace').decode('latin-1')
+        
+        # Consecutive body lines go out as one multi_cell block; only headings switch fonts
+        body = []
         
-        # Split content into lines
-        lines = content.split('\n')
-        for line in lines:
+        def flush_body():
+            if body:
+                pdf.multi_cell(0, 8, txt='\n'.join(body))
+                body.clear()
+        
+        for line in content.split('\n'):
             # Handle section headings
             if line.strip().endswith(':') or (line.strip() and line.strip()[0] == '#'):
+                flush_body()
                 pdf.set_font("Arial", 'B', 14)
-                pdf.cell(200, 10, txt=clean_text(line), ln=True)
+                pdf.cell(200, 10, txt=line, ln=True)
                 pdf.set_font("Arial", size=12)
             else:
-                pdf.multi_cell(0, 8, txt=clean_text(line))
+                body.append(line)
+        flush_body()
         
         return pdf.output(dest='S').encode('latin1')
 
+    @st.cache_data(max_entries=32, show_spinner=False)
     def create_markdown(content, filename):
         return content.encode('utf-8')
 
-    # Display function for content
-    def display_content():
-        if not st.session_state.displayed_content["pre_class"]:
-            return
+    # Display function for content; with `streams`, sections are rendered live and stored once complete
+    # Returns the sections that were cut off by the token cap while streaming
+    def display_content(streams=None):
+        truncated_sections = []
+        if not streams and not st.session_state.displayed_content["pre_class"]:
+            return truncated_sections
         
         topic = st.session_state.current_topic or "current_topic"
         
+        def show_section(section):
+            if streams:
+                truncated = []
+                full = st.write_stream(read_stream(streams[section], truncated))
+                st.session_state.displayed_content[section] = full.strip()
+                if truncated:
+                    truncated_sections.append(section)
+                    st.warning("This document hit the length limit and was cut off.")
+            else:
+                st.write(st.session_state.displayed_content[section])
+        
+        # PDFs are only built once asked for; the bytes are kept with the text they were built from
+        def pdf_download(section):
+            content = st.session_state.displayed_content[section]
+            prepared = st.session_state.get(f"pdf_{section}")
+            if st.button("Prepare PDF", key=f"{section}_pdf_prepare"):
+                prepared = (content, create_pdf(content, f"{section}_{topic}"))
+                st.session_state[f"pdf_{section}"] = prepared
+            if prepared and prepared[0] == content:
+                st.download_button(
+                    label="Download PDF",
+                    data=prepared[1],
+                    file_name=f"{section}_{topic}.pdf",
+                    mime="application/pdf",
+                    key=f"{section}_pdf"
+                )
+        
         col1, col2, col3 = st.tabs(["Pre-Class", "In-Class", "Post-Class"])
         
         with col1:
             st.subheader("Pre-Class Document")
-            st.write(st.session_state.displayed_content["pre_class"])
+            show_section("pre_class")
             
             # Download buttons
-            pdf_btn = st.download_button(
-                label="Download PDF",
-                data=create_pdf(st.session_state.displayed_content["pre_class"], f"pre_class_{topic}"),
-                file_name=f"pre_class_{topic}.pdf",
-                mime="application/pdf",
-                key="pre_class_pdf"
-            )
+            pdf_download("pre_class")
             md_btn = st.download_button(
                 label="Download Markdown",
                 data=create_markdown(st.session_state.displayed_content["pre_class"], f"pre_class_{topic}"),
@@ -370,15 +569,9 @@ def main_app():
         
         with col2:
             st.subheader("In-Class Lesson Plan")
-            st.write(st.session_state.displayed_content["in_class"])
+            show_section("in_class")
             
-            pdf_btn = st.download_button(
-                label="Download PDF",
-                data=create_pdf(st.session_state.displayed_content["in_class"], f"in_class_{topic}"),
-                file_name=f"in_class_{topic}.pdf",
-                mime="application/pdf",
-                key="in_class_pdf"
-            )
+            pdf_download("in_class")
             md_btn = st.download_button(
                 label="Download Markdown",
                 data=create_markdown(st.session_state.displayed_content["in_class"], f"in_class_{topic}"),
@@ -389,15 +582,9 @@ def main_app():
         
         with col3:
             st.subheader("Post-Class Materials")
-            st.write(st.session_state.displayed_content["post_class"])
+            show_section("post_class")
             
-            pdf_btn = st.download_button(
-                label="Download PDF",
-                data=create_pdf(st.session_state.displayed_content["post_class"], f"post_class_{topic}"),
-                file_name=f"post_class_{topic}.pdf",
-                mime="application/pdf",
-                key="post_class_pdf"
-            )
+            pdf_download("post_class")
             md_btn = st.download_button(
                 label="Download Markdown",
                 data=create_markdown(st.session_state.displayed_content["post_class"], f"post_class_{topic}"),
@@ -405,35 +592,55 @@ def main_app():
                 mime="text/markdown",
                 key="post_class_md"
             )
+        
+        return truncated_sections
 
-    # Main content generation
-    if generate_btn:
+    # Main content generation. Returns True once fresh documents have been streamed into the tabs.
+    # Validation failures return early so the rest of the page (history, content) still renders.
+    def generate_materials():
+        content_rendered = False
         current_topic = st.session_state.topic_input if 'topic_input' in st.session_state else None
         if not current_topic:
             st.warning("Please enter a topic first")
-            st.stop()
+            return content_rendered
+        
+        # Reuse materials already generated for this topic and difficulty unless a fresh generation was asked for
+        cached = None if regenerate else find_cached_materials(
+            st.session_state.username, current_topic, st.session_state.selected_difficulty
+        )
         
-        if not api_key:
+        if not cached and not api_key:
             st.warning("Please enter your OpenAI API key")
-            st.stop()
+            return content_rendered
             
         try:
-            with st.spinner(f"Generating {st.session_state.selected_difficulty} level materials for '{current_topic}' using GPT-4o..."):
-                # Generate documents using the current topic from session state
-                pre_class_content = generate_pre_class(current_topic, st.session_state.selected_difficulty, api_key)
-                in_class_content = generate_in_class(current_topic, st.session_state.selected_difficulty, api_key)
-                post_class_content = generate_post_class(current_topic, st.session_state.selected_difficulty, api_key)
-                
-                # Store in session state
-                st.session_state.displayed_content = {
-                    "pre_class": pre_class_content,
-                    "in_class": in_class_content,
-                    "post_class": post_class_content
-                }
+            if cached:
+                spinner_text = f"Loading saved {st.session_state.selected_difficulty} level materials for '{current_topic}'..."
+            else:
+                spinner_text = f"Generating {st.session_state.selected_difficulty} level materials for '{current_topic}' using GPT-4o..."
+            with st.spinner(spinner_text):
                 st.session_state.current_topic = current_topic
+                truncated_sections = []
+                if cached:
+                    st.session_state.displayed_content = cached
+                else:
+                    # Generate documents using the current topic from session state
+                    streams = start_generation(current_topic, st.session_state.selected_difficulty, api_key)
+                    
+                    # Stream into the tabs; display_content stores each section in session state as it finishes
+                    st.session_state.displayed_content = {
+                        "pre_class": None,
+                        "in_class": None,
+                        "post_class": None
+                    }
+                    truncated_sections = display_content(streams)
+                    content_rendered = True
+                pre_class_content = st.session_state.displayed_content["pre_class"]
+                in_class_content = st.session_state.displayed_content["in_class"]
+                post_class_content = st.session_state.displayed_content["post_class"]
                 
-                # Save to history in database
-                save_history_to_db(
+                # Save to history in database; cut-off generations are kept but flagged so they aren't reused
+                timestamp = save_history_to_db(
                     st.session_state.username,
                     current_topic,
                     st.session_state.selected_difficulty,
@@ -441,24 +648,49 @@ def main_app():
                         "pre_class": pre_class_content,
                         "in_class": in_class_content,
                         "post_class": post_class_content
-                    }
+                    },
+                    truncated=bool(truncated_sections)
                 )
                 
-                # Reload history from DB to update session state
-                st.session_state.history = load_history_from_db(st.session_state.username)
+                # Patch the saved entry into session state (newest first) rather than reloading every row
+                st.session_state.history_titles = [(current_topic, st.session_state.selected_difficulty, timestamp)] + [
+                    title for title in st.session_state.history_titles if title[0] != current_topic
+                ]
+                st.session_state.history_export = None
                 
-                st.success("Materials generated successfully!")
-                st.rerun()
+                if truncated_sections:
+                    st.warning(f"Some documents hit the {MAX_DOCUMENT_TOKENS}-token limit and were cut off. "
+                               "They were saved to your history as generated, but won't be reused "
+                               "as saved materials for this topic.")
+                elif cached:
+                    st.success("Loaded your saved materials for this topic and difficulty. "
+                               "Tick 'Regenerate' to create new ones.")
+                else:
+                    st.success("Materials generated successfully!")
         
         except Exception as e:
             st.error(f"Error generating materials: {str(e)}")
             st.info("Please check your API key and try again")
+        
+        return content_rendered
+
+    content_rendered = generate_materials() if generate_btn else False
 
-    # Display content if available
+    with history_section:
+        # Display history with selection
+        if st.session_state.history_titles:
+            history_topics = [title[0] for title in st.session_state.history_titles]
+            st.selectbox("Previously Generated Topics:", history_topics, key="history_select")
+            st.button("Load Selected Topic", key="load_topic_btn", on_click=load_selected_topic)
+        else:
+            st.info("No generation history yet")
+
+    # Display content if available (a fresh generation has already been streamed into the tabs above)
     if (st.session_state.displayed_content["pre_class"] and 
         st.session_state.displayed_content["in_class"] and 
         st.session_state.displayed_content["post_class"]):
-        display_content()
+        if not content_rendered:
+            display_content()
     else:
         # Display instructions if no content
         st.info("""
@@ -504,17 +736,20 @@ def main_app():
             """)
 
     # Export history feature
-    if st.session_state.history:
+    if st.session_state.history_titles:
         st.sidebar.divider()
         st.sidebar.header("Export History")
-        history_json = json.dumps(st.session_state.history, indent=2)
-        st.sidebar.download_button(
-            label="Download History as JSON",
-            data=history_json,
-            file_name="prepclass_history.json",
-            mime="application/json",
-            key="history_download"
-        )
+        # Document bodies are only read from the DB once an export is asked for
+        if st.sidebar.button("Prepare History Export", key="history_export_btn"):
+            st.session_state.history_export = json.dumps(load_history_from_db(st.session_state.username), indent=2)
+        if st.session_state.history_export:
+            st.sidebar.download_button(
+                label="Download History as JSON",
+                data=st.session_state.history_export,
+                file_name="prepclass_history.json",
+                mime="application/json",
+                key="history_download"
+            )
 
     # Add footer
     st.divider()